@@ -150,6 +150,7 @@ from odemis.gui.util.img import add_alpha_byte, apply_rotation, apply_shear, app
 from odemis.util import intersect
 import os
 import sys
+import time
 import wx
 from wx.lib import wxcairo
 
@@ -457,9 +458,26 @@ class BufferedCanvas(wx.Panel):
         )
 
         ctx = wxcairo.ContextFromDC(dc_view)
+        self._clip_to_update_region(ctx)
         self._draw_view_overlays(ctx)
         del ctx  # needs to be dereferenced to force flushing on Windows
 
+    def _clip_to_update_region(self, ctx):
+        """ Clip the given view context to the area damaged by the current paint event
+
+        This limits the cost of the view overlay drawing to the changed area
+        when only a part of the canvas is refreshed (eg, via RefreshRect).
+        Must only be called while handling a paint event.
+
+        ctx (cairo context): the view context on which the overlays will be drawn
+
+        """
+
+        box = self.GetUpdateRegion().GetBox()
+        if box.width > 0 and box.height > 0:
+            ctx.rectangle(box.x, box.y, box.width, box.height)
+            ctx.clip()
+
     def on_size(self, evt):
         """ Resize the bitmap buffer so it's size will match the view's """
 
@@ -773,6 +791,11 @@ class BitmapCanvas(BufferedCanvas):
     A canvas that can display multiple overlapping images at various position
     and scale, but it cannot be moved by the user.
     """
+
+    # Overridden (as a property) by the draggable subclasses; used to pick a
+    # fast preview rendering while the user is interacting with the canvas
+    dragging = False
+
     def __init__(self, *args, **kwargs):
         super(BitmapCanvas, self).__init__(*args, **kwargs)
 
@@ -784,9 +807,19 @@ class BitmapCanvas(BufferedCanvas):
         self.scale = 1.0  # px/m
         self.margins = (0, 0)
 
+        # Cache of the cairo surfaces wrapping the image data, to avoid
+        # recreating them on every draw when the images haven't changed.
+        # id(im) -> (im, cairo format, cairo.ImageSurface)
+        self._surface_cache = {}
+        # Cache of the cropped copies made when upscaling (cf get_sub_img):
+        # id(im) -> (im, (intersection, b_im_rect, total_scale), sub im, tl)
+        self._sub_img_cache = {}
+
     def clear(self):
         """ Remove the images and clear the canvas """
         self.images = [None]
+        self._surface_cache = {}
+        self._sub_img_cache = {}
         BufferedCanvas.clear(self)
 
     def set_images(self, im_args):
@@ -861,6 +894,9 @@ class BitmapCanvas(BufferedCanvas):
                 images.append(im)
 
         self.images = images
+        # The surfaces and sub-images wrap the old data, so they cannot be reused
+        self._surface_cache = {}
+        self._sub_img_cache = {}
 
     def draw(self, interpolate_data=False):
         """ Draw the images and overlays into the buffer
@@ -879,6 +915,12 @@ class BitmapCanvas(BufferedCanvas):
         if not self or 0 in self.ClientSize:
             return
 
+        if interpolate_data and self.dragging:
+            # Interpolation is too costly to keep the drag smooth, so draw a
+            # fast nearest-neighbour preview. The full-quality redraw happens
+            # automatically when the drag ends (cf on_left_up).
+            interpolate_data = False
+
         ctx = wxcairo.ContextFromDC(self._dc_buffer)
 
         self._draw_background(ctx)
@@ -1169,7 +1211,24 @@ class BitmapCanvas(BufferedCanvas):
             # If very little data is trimmed, it's better to scale the entire image than to create
             # a slightly smaller copy first.
             if b_im_rect[2] > intersection[2] * 1.1 or b_im_rect[3] > intersection[3] * 1.1:
-                im_data, tl = get_sub_img(intersection, b_im_rect, im_data, total_scale)
+                # Consecutive draws tend to request the exact same crop (eg,
+                # when only the merge ratio changed), so reuse the copy made
+                # on the previous call when all the inputs are identical.
+                cached = self._sub_img_cache.get(id(im_data))
+                if (cached is not None and cached[0] is im_data and
+                        cached[1] == (intersection, b_im_rect, total_scale)):
+                    im_data, tl = cached[2], cached[3]
+                else:
+                    if cached is not None:
+                        # Also drop the surface of the crop being replaced,
+                        # otherwise it would stay cached forever (eg, while
+                        # panning over a static image).
+                        self._surface_cache.pop(id(cached[2]), None)
+                    orig_im = im_data
+                    im_data, tl = get_sub_img(intersection, b_im_rect, im_data, total_scale)
+                    self._sub_img_cache[id(orig_im)] = (orig_im,
+                                                        (intersection, b_im_rect, total_scale),
+                                                        im_data, tl)
                 b_im_rect = (tl[0], tl[1], b_im_rect[2], b_im_rect[3], )
 
         # Render the image data to the context
@@ -1182,11 +1241,22 @@ class BitmapCanvas(BufferedCanvas):
         height, width, _ = im_data.shape
         # logging.debug("Image data shape is %s", im_data.shape)
 
-        # Note: Stride calculation is done automatically when no stride parameter is provided.
-        stride = cairo.ImageSurface.format_stride_for_width(im_format, width)
-        # In Cairo a surface is a target that it can render to. Here we're going to use it as the
-        #  source for a pattern
-        imgsurface = cairo.ImageSurface.create_for_data(im_data, im_format, width, height, stride)
+        # Creating a surface for the data is not free, so between two calls of
+        # set_images() (ie, identical data), reuse the one of the previous draw.
+        cached = self._surface_cache.get(id(im_data))
+        if cached is not None and cached[0] is im_data and cached[1] == im_format:
+            imgsurface = cached[2]
+        else:
+            # Note: Stride calculation is done automatically when no stride parameter is provided.
+            stride = cairo.ImageSurface.format_stride_for_width(im_format, width)
+            # In Cairo a surface is a target that it can render to. Here we're going to use it as the
+            #  source for a pattern
+            imgsurface = cairo.ImageSurface.create_for_data(im_data, im_format, width, height, stride)
+            # Only cache the full images and the (cached) sub-images, so that
+            # short-lived arrays don't pile up in the cache.
+            if (any(im_data is im for im in self.images) or
+                    any(im_data is c[2] for c in self._sub_img_cache.values())):
+                self._surface_cache[id(im_data)] = (im_data, im_format, imgsurface)
 
         # In Cairo a pattern is the 'paint' that it uses to draw
         surfpat = cairo.SurfacePattern(imgsurface)
@@ -1381,6 +1451,12 @@ class DraggableCanvas(BitmapCanvas):
         # drag occurred.
         self.was_dragged = False
 
+        # Rate-limit the refreshes caused by mouse motion while dragging: the
+        # events can arrive much more often than the screen can be updated.
+        self._drag_refresh_period = 0.016  # s (~60 fps)
+        self._next_drag_refresh = 0  # time at which the next refresh is allowed
+        self._drag_refresh_call = None  # wx.CallLater for the trailing refresh
+
     # Properties
 
     @property
@@ -1544,11 +1620,26 @@ class DraggableCanvas(BitmapCanvas):
                 min(max(drag_shift[1], -self.margins[1]), self.margins[1])
             )
 
-            self.Refresh()
+            now = time.time()
+            if now >= self._next_drag_refresh:
+                self._next_drag_refresh = now + self._drag_refresh_period
+                self.Refresh(eraseBackground=False)
+            elif self._drag_refresh_call is None or not self._drag_refresh_call.IsRunning():
+                # Make sure the latest position eventually gets displayed,
+                # even if no more motion events arrive.
+                delay = max(1, int((self._next_drag_refresh - now) * 1000))
+                self._drag_refresh_call = wx.CallLater(delay, self._on_drag_refresh)
 
         self.was_dragged = self.dragging
         super(DraggableCanvas, self).on_motion(evt)
 
+    def _on_drag_refresh(self):
+        """ Display the latest drag position (cf the throttling in on_motion) """
+        if not self:  # Canvas destroyed in the meantime
+            return
+        self._next_drag_refresh = time.time() + self._drag_refresh_period
+        self.Refresh(eraseBackground=False)
+
     # keycode to HFW ratio: 10% of the screen
     _key_to_move = {
         wx.WXK_LEFT: (0.1, 0),
@@ -1631,6 +1722,7 @@ class DraggableCanvas(BitmapCanvas):
 
         # Remember that the device context of the view port is passed!
         ctx = wxcairo.ContextFromDC(dc_view)
+        self._clip_to_update_region(ctx)
         self._draw_view_overlays(ctx)
         del ctx  # needs to be dereferenced to force flushing on Windows
 
@@ -1642,6 +1734,32 @@ class DraggableCanvas(BitmapCanvas):
         return (self.ClientSize.x + self.default_margin * 2,
                 self.ClientSize.y + self.default_margin * 2)
 
+    def on_size(self, evt):
+        """ Grow the bitmap buffer when it can no longer contain the view
+
+        Contrary to the base class, the buffer is never shrunk when the window
+        gets smaller: the extra area just acts as additional margin. This
+        avoids reallocating the (big) bitmap and redrawing everything on every
+        step of an interactive resize. The margins are recomputed on each
+        paint, so the view stays correctly centered whatever the buffer size.
+
+        """
+
+        min_size = self.get_minimum_buffer_size()
+
+        if min_size[0] > self._bmp_buffer_size[0] or min_size[1] > self._bmp_buffer_size[1]:
+            # Round up, so that a sequence of small increases doesn't cause a
+            # reallocation each time.
+            new_size = (((min_size[0] + 63) // 64) * 64,
+                        ((min_size[1] + 63) // 64) * 64)
+            logging.debug("Buffer size increased, redrawing...")
+            self.resize_buffer(new_size)
+            self.update_drawing()
+        else:
+            # eraseBackground=False prevents flicker
+            self.Refresh(eraseBackground=False)
+        evt.Skip()
+
     def _calc_bg_offset(self, new_pos):
         """ Calculate the offset needed for the checkered background after a canvas shift
 
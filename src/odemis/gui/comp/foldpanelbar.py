@@ -20,6 +20,7 @@
     Odemis. If not, see http://www.gnu.org/licenses/.
 """
 from __future__ import division
+from contextlib import contextmanager
 from odemis.gui import img, BG_COLOUR_MAIN
 from odemis.gui.util.conversion import change_brightness, wxcol_to_frgb
 import wx
@@ -28,12 +29,36 @@ import wx
 CAPTION_BAR_SIZE = (-1, 40)
 CAPTION_PADDING_LEFT = 10
 CAPTION_PADDING_RIGHT = 6
-SCROLLBAR_WIDTH = 0
+
+# Width of a vertical scrollbar, queried once from the system (cf _scrollbar_width)
+_scrollbar_width_cache = None
+
+
+def _scrollbar_width():
+    """ Return the width (int) of a vertical scrollbar on this system """
+    global _scrollbar_width_cache
+    if _scrollbar_width_cache is None:
+        _scrollbar_width_cache = wx.SystemSettings.GetMetric(wx.SYS_VSCROLL_X)
+    return _scrollbar_width_cache
 
 
 wxEVT_CAPTIONBAR = wx.NewEventType()
 EVT_CAPTIONBAR = wx.PyEventBinder(wxEVT_CAPTIONBAR, 0)
 
+# The fold icons are identical for every caption bar, so they are loaded once
+# and shared between all the instances (cf _get_fold_icons)
+_fold_icons = None
+
+
+def _get_fold_icons():
+    """ Return the (shared) wx.ImageList with the expanded/collapsed icons """
+    global _fold_icons
+    if _fold_icons is None:
+        _fold_icons = wx.ImageList(16, 16)
+        _fold_icons.Add(img.getBitmap("icon/arr_down.png"))
+        _fold_icons.Add(img.getBitmap("icon/arr_right.png"))
+    return _fold_icons
+
 
 class FoldPanelBar(wx.Panel):
     """ This window can be be used as a vertical side bar which may contain foldable sub panels
@@ -55,8 +80,15 @@ class FoldPanelBar(wx.Panel):
         self.Bind(EVT_CAPTIONBAR, self.on_caption_press)
         self.Bind(wx.EVT_SIZE, self.OnSize)
 
-        global SCROLLBAR_WIDTH
-        SCROLLBAR_WIDTH = wx.SystemSettings.GetMetric(wx.SYS_VSCROLL_X)
+        # When True, add_item defers the parent relayout (cf batch())
+        self._batching = False
+
+        # Cached result of has_vert_scrollbar, None when to recompute
+        self._has_vscroll = None
+        # The scrollbar presence depends on the *parent*'s client size, which
+        # can change (eg, top-level resize) without this bar, laid out against
+        # the virtual area, receiving an EVT_SIZE => also invalidate then.
+        parent.Bind(wx.EVT_SIZE, self._on_parent_size)
 
         assert isinstance(parent, wx.ScrolledWindow)
 
@@ -67,10 +99,14 @@ class FoldPanelBar(wx.Panel):
             evt.get_tag().expand()
 
     def has_vert_scrollbar(self):
-        size = self.Parent.GetSize()
-        vsize = self.Parent.GetVirtualSize()
+        # Cached, as it's queried on every caption bar repaint, and the sizes
+        # only change on relayout (which triggers OnSize)
+        if self._has_vscroll is None:
+            size = self.Parent.GetSize()
+            vsize = self.Parent.GetVirtualSize()
+            self._has_vscroll = vsize[1] > size[1]
 
-        return vsize[1] > size[1]
+        return self._has_vscroll
 
     def has_horz_scrollbar(self):
         size = self.Parent.GetSize()
@@ -79,29 +115,56 @@ class FoldPanelBar(wx.Panel):
         return vsize[0] > size[0]
 
     def OnSize(self, evt):
+        self._has_vscroll = None  # scrollbar presence may have changed
         self.SetSize(self.Parent.GetVirtualSize())
         evt.Skip()
 
+    def _on_parent_size(self, evt):
+        self._has_vscroll = None  # scrollbar presence may have changed
+        evt.Skip()
+
     ##############################
     # Fold panel items mutations
     ##############################
 
     def add_item(self, item):
-        """ Add a foldpanel item to the bar """
+        """ Add a foldpanel item to the bar
+
+        When called inside a batch() block, the (costly) relayout of the
+        containing ScrolledWindow is deferred until the end of the block.
+
+        """
         assert isinstance(item, FoldPanelItem)
         self._sizer.Add(item, flag=wx.EXPAND)
-        self.Parent.Layout()
-        self.Parent.FitInside()
+        if not self._batching:
+            self.Parent.Layout()
+            self.Parent.FitInside()
+
+    @contextmanager
+    def batch(self):
+        """ Context manager to add several items with a single relayout
+
+        Usage: with foldbar.batch(): foldbar.add_item(...); ...
+
+        """
+        self.Parent.Freeze()
+        self._batching = True
+        try:
+            yield self
+        finally:
+            self._batching = False
+            self.Parent.Thaw()
+            self.Parent.Layout()
+            self.Parent.FitInside()
 
     def remove_item(self, item):
         assert isinstance(item, FoldPanelItem)
 
-        for child in self.GetChildren():
-            if child == item:
-                child.Destroy()
-                self.Parent.Layout()
-                self.Parent.FitInside()
-                return
+        if item.Parent is self:
+            # Destroy() automatically detaches the item from the sizer
+            item.Destroy()
+            self.Parent.Layout()
+            self.Parent.FitInside()
 
     def create_and_add_item(self, label, collapsed):
         item = FoldPanelItem(self, label=label, collapsed=collapsed)
@@ -157,14 +220,26 @@ class FoldPanelItem(wx.Panel):
         evt.Skip()
 
     def collapse(self):
-        self._caption_bar.collapse()
-        self._container.Hide()
-        self.Refresh()
+        # Freeze the whole scrolled window, so the hide and the relayout
+        # appear on screen as a single update
+        scroll_win = self.Parent.Parent
+        scroll_win.Freeze()
+        try:
+            self._caption_bar.collapse()
+            self._container.Hide()
+            self.Refresh()
+        finally:
+            scroll_win.Thaw()
 
     def expand(self):
-        self._caption_bar.expand()
-        self._container.Show()
-        self.Refresh()
+        scroll_win = self.Parent.Parent
+        scroll_win.Freeze()
+        try:
+            self._caption_bar.expand()
+            self._container.Show()
+            self.Refresh()
+        finally:
+            scroll_win.Thaw()
 
     def Show(self, show=True):
         wx.Panel.Show(self, show)
@@ -205,15 +280,13 @@ class FoldPanelItem(wx.Panel):
 
     def remove_item(self, item):
         """ Remove the given item from the panel """
-        for child in self._container.GetChildren():
-            if child == item:
-                child.Destroy()
-                self.Refresh()
-                return
+        if item.Parent is self._container:
+            item.Destroy()
+            self.Refresh()
 
     def remove_all(self):
         """ Remove all child windows and sizers from the panel """
-        for child in self._container.GetChildren():
+        for child in list(self._container.GetChildren()):
             child.Destroy()
         self.Refresh()
 
@@ -265,19 +338,36 @@ class CaptionBar(wx.Window):
         self._mouse_hovering = False
         self._logo = None  # wx.Bitmap or None
 
+        # Pre-rendered gradient backgrounds, as they are expensive to draw:
+        # (width, height, hovering, background colour) -> wx.Bitmap
+        self._gradient_cache = {}
+
+        # Memoized gradient end colours: (hovering, background colour) -> (col1, col2)
+        self._gradient_cols = {}
+
+        # Cached position and width of the fold icon area, as computing it
+        # requires querying the (grand)parent sizes. None when to recompute.
+        self._icon_area = None  # (has_vscroll, x_pos, width) or None
+
+        # wx.CallLater coalescing the repaints caused by hover changes
+        self._hover_refresh = None
+
         # Set Icons
         self._icon_size = wx.Size(16, 16)
-        self._foldIcons = wx.ImageList(self._icon_size.x, self._icon_size.y)
-        bmp = img.getBitmap("icon/arr_down.png")
-        self._foldIcons.Add(bmp)
-        bmp = img.getBitmap("icon/arr_right.png")
-        self._foldIcons.Add(bmp)
+        self._foldIcons = _get_fold_icons()
 
         self.Bind(wx.EVT_PAINT, self.on_paint)
+        self.Bind(wx.EVT_SIZE, self.on_size)
 
         if isinstance(self.Parent, FoldPanelItem):
             self.Bind(wx.EVT_MOUSE_EVENTS, self.on_mouse_event)
 
+    def on_size(self, evt):
+        """ Drop the cached backgrounds and icon position, as they no longer fit the bar """
+        self._gradient_cache = {}
+        self._icon_area = None
+        evt.Skip()
+
     def set_caption(self, caption):
         self._caption = caption
 
@@ -312,29 +402,46 @@ class CaptionBar(wx.Window):
 
     def on_paint(self, _):
         """ Handle the ``wx.EVT_PAINT`` event for L{CaptionBar} """
-        dc = wx.PaintDC(self)
+        # Buffered, so the gradient + text + icon land on screen as a single
+        # blit, without flicker (the background style is already BG_STYLE_PAINT)
+        dc = wx.AutoBufferedPaintDC(self)
         win_rect = self.GetRect()
 
+        # Nothing to draw on degenerate bars (eg, during sizer construction)
+        if win_rect.width <= 0 or win_rect.height <= 0:
+            return
+
+        # Icon-only repaints (cf redraw_icon_bitmap) don't touch the caption
+        # text or the logo, so limit the drawing to the damaged area and only
+        # redraw the background and the icon.
+        upd_box = self.GetUpdateRegion().GetBox()
+        icon_only = (isinstance(self.Parent, FoldPanelItem) and upd_box.width > 0 and
+                     upd_box.x >= (self.Parent.Parent.Size.x - self._icon_size.x -
+                                   CAPTION_PADDING_RIGHT - _scrollbar_width()))
+        if icon_only:
+            dc.SetClippingRegion(upd_box)
+
         self._draw_gradient(dc, win_rect)
 
-        caption_font = self.Parent.GetFont()
-        dc.SetFont(caption_font)
+        if not icon_only:
+            caption_font = self.Parent.GetFont()
+            dc.SetFont(caption_font)
 
-        if isinstance(self.Parent, FoldPanelItem):
-            dc.SetTextForeground(self.Parent.GetForegroundColour())
-        else:
-            dc.SetTextForeground(self.GetForegroundColour())
+            if isinstance(self.Parent, FoldPanelItem):
+                dc.SetTextForeground(self.Parent.GetForegroundColour())
+            else:
+                dc.SetTextForeground(self.GetForegroundColour())
 
-        y_pos = (win_rect.GetHeight() - abs(caption_font.GetPixelSize().GetHeight())) // 2
+            y_pos = (win_rect.GetHeight() - abs(caption_font.GetPixelSize().GetHeight())) // 2
 
-        dc.DrawText(self._caption, CAPTION_PADDING_LEFT, y_pos)
+            dc.DrawText(self._caption, CAPTION_PADDING_LEFT, y_pos)
 
-        if self._logo:
-            dc.DrawBitmap(self._logo,
-                          self.Parent.Size.x
-                           -self._logo.Width - 20  # 20 = extra padding for logo
-                           -self._icon_size.x - CAPTION_PADDING_RIGHT,
-                          (win_rect.Height - self._logo.Height) // 2)
+            if self._logo:
+                dc.DrawBitmap(self._logo,
+                              self.Parent.Size.x
+                               -self._logo.Width - 20  # 20 = extra padding for logo
+                               -self._icon_size.x - CAPTION_PADDING_RIGHT,
+                              (win_rect.Height - self._logo.Height) // 2)
 
         # Only draw the icon if it's part of a FoldPanelItem
         if isinstance(self.Parent, FoldPanelItem):
@@ -352,57 +459,98 @@ class CaptionBar(wx.Window):
 
     def _draw_gradient(self, dc, rect):
         """ Draw a vertical gradient background, using the background colour as a starting point
+
+        The rendered gradient is cached as a bitmap, so repaints (eg, on
+        hovering) only cost one blit.
+
         """
 
         if rect.height < 1 or rect.width < 1:
             return
 
-        dc.SetPen(wx.TRANSPARENT_PEN)
+        key = (rect.width, rect.height, self._mouse_hovering,
+               self.Parent.GetBackgroundColour().GetRGB())
+        bmp = self._gradient_cache.get(key)
+        if bmp is None:
+            bmp = wx.Bitmap(rect.width, rect.height)
+            mdc = wx.MemoryDC(bmp)
+            self._render_gradient(mdc, wx.Rect(0, 0, rect.width, rect.height))
+            mdc.SelectObject(wx.NullBitmap)  # detach, so the bitmap can be drawn
+            self._gradient_cache[key] = bmp
 
-        # calculate gradient coefficients
+        dc.DrawBitmap(bmp, rect.x, rect.y)
 
-        bck_col = wxcol_to_frgb(self.Parent.GetBackgroundColour())
-        if self._mouse_hovering:
-            col1 = change_brightness(bck_col, 0.15)
-            col2 = change_brightness(bck_col, 0.10)
-        else:
-            col1 = change_brightness(bck_col, 0.10)
-            col2 = bck_col
+    def _render_gradient(self, dc, rect):
+        """ Actually render the gradient background (cf _draw_gradient) """
 
+        dc.SetPen(wx.TRANSPARENT_PEN)
+
+        # gradient coefficients, memoized per (hover state, background colour)
+        wx_bck_col = self.Parent.GetBackgroundColour()
+        col_key = (self._mouse_hovering, wx_bck_col.GetRGB())
+        try:
+            col1, col2 = self._gradient_cols[col_key]
+        except KeyError:
+            bck_col = wxcol_to_frgb(wx_bck_col)
+            if self._mouse_hovering:
+                col1 = change_brightness(bck_col, 0.15)
+                col2 = change_brightness(bck_col, 0.10)
+            else:
+                col1 = change_brightness(bck_col, 0.10)
+                col2 = bck_col
+            self._gradient_cols[col_key] = (col1, col2)
+
+        gc = wx.GraphicsContext.Create(dc)
+        if gc:
+            # Let the native 2D backend rasterize the gradient in one call,
+            # instead of drawing it line by line in Python.
+            wxcol1 = wx.Colour(*[int(round(c * 255)) for c in col1])
+            wxcol2 = wx.Colour(*[int(round(c * 255)) for c in col2])
+            brush = gc.CreateLinearGradientBrush(rect.x, rect.y,
+                                                 rect.x, rect.y + rect.height,
+                                                 wxcol1, wxcol2)
+            gc.SetBrush(brush)
+            gc.DrawRectangle(rect.x, rect.y, rect.width, rect.height)
+            return
+
+        # Fallback for backends without a GraphicsContext: draw line by line
         r1, g1, b1 = col1
         r2, g2, b2 = col2
-        rstep = (r2 - r1) / rect.height
-        gstep = (g2 - g1) / rect.height
-        bstep = (b2 - b1) / rect.height
-
-        rf, gf, bf = col1
-        for y in range(rect.y, rect.y + rect.height):
-            cur_col = (rf * 255, gf * 255, bf * 255)
-            dc.SetBrush(wx.Brush(cur_col, wx.BRUSHSTYLE_SOLID))
-            dc.DrawRectangle(rect.x, rect.y + (y - rect.y), rect.width, rect.height)
-            rf = rf + rstep
-            gf = gf + gstep
-            bf = bf + bstep
+        h = rect.height
+        # Precompute the whole colour ramp, so only the drawing itself is left
+        # in the loop
+        ramp = [((r1 + (r2 - r1) * i / h) * 255,
+                 (g1 + (g2 - g1) * i / h) * 255,
+                 (b1 + (b2 - b1) * i / h) * 255) for i in range(h)]
+
+        x, width = rect.x, rect.width
+        set_brush = dc.SetBrush
+        draw_rectangle = dc.DrawRectangle
+        brush = wx.Brush
+        solid = wx.BRUSHSTYLE_SOLID
+
+        for y, cur_col in zip(range(rect.y, rect.y + h), ramp):
+            set_brush(brush(cur_col, solid))
+            # Each scanline is 1 px high (the full rect height used to be
+            # drawn for every row, doing height x the necessary fill work)
+            draw_rectangle(x, y, width, 1)
 
     def on_mouse_event(self, event):
         """ Mouse event handler """
         send_event = False
 
-        if event.LeftDown():
+        if event.LeftDown() or event.LeftDClick():
             # Treat all left-clicks on the caption bar as a toggle event
             send_event = True
 
-        elif event.LeftDClick():
-            send_event = True
-
-        elif event.Entering():
-            # calculate gradient coefficients
-            self._mouse_hovering = True
-            self.Refresh()
-
-        elif event.Leaving():
-            self._mouse_hovering = False
-            self.Refresh()
+        elif event.Entering() or event.Leaving():
+            hovering = event.Entering()
+            if hovering != self._mouse_hovering:
+                self._mouse_hovering = hovering
+                # Coalesce quick enter/leave sequences into (at most) one
+                # repaint per frame, instead of refreshing on every crossing
+                if self._hover_refresh is None or not self._hover_refresh.IsRunning():
+                    self._hover_refresh = wx.CallLater(16, self._on_hover_refresh)
 
         # send the collapse, expand event to the parent
 
@@ -415,20 +563,31 @@ class CaptionBar(wx.Window):
         else:
             event.Skip()
 
+    def _on_hover_refresh(self):
+        """ Repaint the bar with the current hover state (cf on_mouse_event) """
+        if self:  # caption bar might have been destroyed in the meantime
+            self.Refresh(eraseBackground=False)
+
     def redraw_icon_bitmap(self):
         """ Redraws the icons (if they exists). """
 
-        rect = self.GetRect()
-
-        padding_right = CAPTION_PADDING_RIGHT
+        # The icon shifts by the scrollbar width when the scrollbar
+        # appears/disappears, which can happen without this bar being resized
+        # => the cached area is only valid for the same scrollbar state.
+        has_vscroll = (not isinstance(self.Parent, FoldPanelItem)
+                       or self.Parent.has_vert_scrollbar())
+        if self._icon_area is None or self._icon_area[0] != has_vscroll:
+            padding_right = CAPTION_PADDING_RIGHT
 
-        if isinstance(self.Parent, FoldPanelItem) and not self.Parent.has_vert_scrollbar():
-            padding_right += SCROLLBAR_WIDTH
+            if not has_vscroll:
+                padding_right += _scrollbar_width()
 
-        x_pos = self.Parent.Parent.Size.x - self._icon_size.x - padding_right
+            x_pos = self.Parent.Parent.Size.x - self._icon_size.x - padding_right
+            self._icon_area = (has_vscroll, x_pos, self._icon_size.x + padding_right)
 
-        rect.SetX(x_pos)
-        rect.SetWidth(self._icon_size.x + padding_right)
+        rect = self.GetRect()
+        rect.SetX(self._icon_area[1])
+        rect.SetWidth(self._icon_area[2])
         self.RefreshRect(rect)
 
 
@@ -30,6 +30,7 @@ This module contains classes that allow to create ToolBars for the MicroscopeGUI
 """
 from __future__ import division
 
+import collections
 import itertools
 from odemis.gui import model, img
 from odemis.gui.comp.buttons import ImageButton, ImageToggleButton, darken_image
@@ -41,30 +42,16 @@ from odemis.gui.model import TOOL_POINT, TOOL_LINE, TOOL_ACT_ZOOM_FIT, TOOL_RULE
 # Two types of tools:
 # * mode: they are toggle buttons, changing the tool mode of the GUIModel
 # * action: they are just click button, and call a function when pressed
-class Tool(object):
-    def __init__(self, icon, tooltip=None):
-        """
-        icon (string): name of the bitmap without .png, _h.png, _a.png
-         (iow, as found in gui.img)
-        tooltip (string): tool tip content
-        """
-        self.icon = icon
-        self.tooltip = tooltip
-
-
-class ModeTool(Tool):
-    def __init__(self, icon, value_on, value_off, tooltip=None):
-        """
-        value_on (anything): value to set to the VA when the tool is activated
-        value_off (anything): value to set when the tool is explicitly disabled
-        """
-        Tool.__init__(self, icon, tooltip=tooltip)
-        self.value_on = value_on
-        self.value_off = value_off
-
-
-class ActionTool(Tool):
-    pass
+# They are immutable descriptions, so plain namedtuples are enough (and
+# lighter than full classes with a __dict__ per instance).
+# icon (string): name of the bitmap without .png, _h.png, _a.png
+#  (iow, as found in gui.img)
+# tooltip (string or None): tool tip content
+# value_on (anything): value to set to the VA when the tool is activated
+# value_off (anything): value to set when the tool is explicitly disabled
+Tool = collections.namedtuple("Tool", ["icon", "tooltip"])
+ModeTool = collections.namedtuple("ModeTool", ["icon", "value_on", "value_off", "tooltip"])
+ActionTool = collections.namedtuple("ActionTool", ["icon", "tooltip"])
 
 
 TOOLS = {
@@ -153,6 +140,60 @@ TOOLS = {
 }
 
 
+# Cache of the bitmaps of every tool button, as loading (and darkening) them
+# involves decoding the PNG files: icon name -> (bmp, bmpa, bmph, bmpd)
+_button_bmp_cache = {}
+
+
+def _get_button_bitmaps(img_prefix):
+    """ Return the four bitmaps (normal, active, hover, disabled) of a tool button
+
+    img_prefix (str): name of the bitmap without .png, _h.png, _a.png,
+      as found in gui.img menu/
+
+    """
+    try:
+        return _button_bmp_cache[img_prefix]
+    except KeyError:
+        bmp = img.getBitmap("menu/" + img_prefix + ".png")
+        bmpa = img.getBitmap("menu/" + img_prefix + "_a.png")
+        bmph = img.getBitmap("menu/" + img_prefix + "_h.png")
+
+        dimg = img.getImage("menu/" + img_prefix + ".png")
+        darken_image(dimg, 0.5)
+        bmpd = dimg.ConvertToBitmap()
+
+        bmps = (bmp, bmpa, bmph, bmpd)
+        _button_bmp_cache[img_prefix] = bmps
+        return bmps
+
+
+class _ModeBinding(object):
+    """ Keeps a mode tool toggle button and its VA synchronized
+
+    One instance is created per mode tool. It replaces the pair of closures
+    previously created in _add_mode_tool, so each binding costs a few slots
+    instead of two function objects with their cell variables.
+    """
+    __slots__ = ("va", "value_on", "value_off", "btn")
+
+    def __init__(self, va, value_on, value_off, btn):
+        self.va = va
+        self.value_on = value_on
+        self.value_off = value_off
+        self.btn = btn
+
+    def on_click(self, evt):
+        if evt.isDown:
+            self.va.value = self.value_on
+        else:
+            self.va.value = self.value_off
+
+    @call_in_wx_main
+    def on_va_change(self, new_value):
+        self.btn.SetToggle(new_value == self.value_on)
+
+
 class ToolBar(wx.Panel):
 
     def __init__(self, *args, **kwargs):
@@ -201,9 +242,12 @@ class ToolBar(wx.Panel):
 
         self._buttons = {}
 
-        # References of va callbacks are stored in this list, to prevent un-subscription
+        # References of the mode bindings are stored in this list, to prevent un-subscription
         self._mode_callbacks = []
 
+        # Whether a (deferred) layout of the button panel is already scheduled
+        self._layout_pending = False
+
     def add_tool(self, tool_id, handler):
         """ Add a tool and it's event handler to the toolbar
 
@@ -228,33 +272,15 @@ class ToolBar(wx.Panel):
         btn = self._add_button(tool_id, ImageToggleButton, tooltype.icon, tooltype.tooltip)
         self._buttons[tool_id] = btn
 
-        value_on = tooltype.value_on
-        value_off = tooltype.value_off
-
-        # functions to handle synchronization VA <-> toggle button
-        def _on_click(evt, va=va, value_on=value_on, value_off=value_off):
-            if evt.isDown:
-                va.value = value_on
-            else:
-                va.value = value_off
-
-        @call_in_wx_main
-        def _on_va_change(new_value, value_on=value_on, btn=btn):
-            btn.SetToggle(new_value == value_on)
+        binding = _ModeBinding(va, tooltype.value_on, tooltype.value_off, btn)
 
         # FIXME: It doesn't generate evt_togglebutton
-        btn.Bind(wx.EVT_BUTTON, _on_click)
-        va.subscribe(_on_va_change)
-        self._mode_callbacks.append(_on_va_change)
+        btn.Bind(wx.EVT_BUTTON, binding.on_click)
+        va.subscribe(binding.on_va_change)
+        self._mode_callbacks.append(binding)
 
     def _add_button(self, tool_id, cls, img_prefix, tooltip=None):
-        bmp = img.getBitmap("menu/" + img_prefix + ".png")
-        bmpa = img.getBitmap("menu/" + img_prefix + "_a.png")
-        bmph = img.getBitmap("menu/" + img_prefix + "_h.png")
-
-        dimg = img.getImage("menu/" + img_prefix + ".png")
-        darken_image(dimg, 0.5)
-        bmpd = dimg.ConvertToBitmap()
+        bmp, bmpa, bmph, bmpd = _get_button_bitmaps(img_prefix)
 
         btn = cls(self.btn_panel, bitmap=bmp, size=(24, 24))
         btn.bmpSelected = bmpa
@@ -283,9 +309,20 @@ class ToolBar(wx.Panel):
         else:  # wx.HORIZONTAL
             self.btn_sizer.Add(btn, border=5, flag=wx.LEFT | wx.RIGHT | wx.TOP)
 
-        self.btn_panel.Layout()
+        # Adding tools one by one would cause one layout pass per button, so
+        # coalesce them into a single deferred pass
+        if not self._layout_pending:
+            self._layout_pending = True
+            wx.CallAfter(self._do_layout)
+
         return btn
 
+    def _do_layout(self):
+        """ Lay out the buttons added since the previous pass (cf _add_button) """
+        self._layout_pending = False
+        if self:  # toolbar might have been destroyed in the meantime
+            self.btn_panel.Layout()
+
     def enable_button(self, tool_id, enable):
         self._buttons[tool_id].Enable(enable)
 
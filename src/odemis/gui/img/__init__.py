@@ -16,6 +16,7 @@ You should have received a copy of the GNU General Public License along with Ode
 '''
 from __future__ import division
 
+import functools
 import pkg_resources
 import wx
 
@@ -40,12 +41,14 @@ def getImage(fn):
     return wx.Image(getStream(fn))  # , wx.BITMAP_TYPE_PNG)
 
 
+@functools.lru_cache(maxsize=None)
 def getBitmap(fn):
     """
     Load an image file into a wx.Bitmap
     fn (str): name of the filename (including the extension), starting after
        "src/odemis/gui/img"
-    return (wx.Bitmap)
+    return (wx.Bitmap): the bitmap is cached and shared between all the
+      callers, so it must not be modified
     """
     return wx.Bitmap(getImage(fn))
 
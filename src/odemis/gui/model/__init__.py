@@ -27,6 +27,8 @@ from past.builtins import basestring, long
 import queue
 from abc import ABCMeta
 import collections
+import collections.abc
+from concurrent import futures
 import logging
 import math
 from odemis import model
@@ -49,6 +51,10 @@ STATE_OFF = 0
 STATE_ON = 1
 STATE_DISABLED = 2  # TODO: use this state when cannot be used
 
+# All the hardware states, used as VA choices (built once, as every GUI model
+# construction needs it)
+HW_STATES = frozenset((STATE_OFF, STATE_ON, STATE_DISABLED))
+
 # Chamber states
 CHAMBER_UNKNOWN = 0  # Chamber in an unknown state
 CHAMBER_VENTED = 1   # Chamber can be opened
@@ -61,6 +67,8 @@ VIEW_LAYOUT_ONE = 0  # one big view
 VIEW_LAYOUT_22 = 1  # 2x2 layout
 VIEW_LAYOUT_FULLSCREEN = 2  # Fullscreen view (not yet supported)
 
+VIEW_LAYOUTS = frozenset((VIEW_LAYOUT_ONE, VIEW_LAYOUT_22, VIEW_LAYOUT_FULLSCREEN))
+
 # The different tools (selectable in the tool bar). First, the "mode" ones:
 TOOL_NONE = 0  # No tool (normal)
 TOOL_ZOOM = 1  # Select the region to zoom in
@@ -268,15 +276,14 @@ class MainGUIData(object):
             comps_with_role = []
             components = model.getComponents()
 
+            role_to_attr = self._ROLE_TO_ATTR
             for c in components:
                 if c.role is None:
                     continue
-                try:
-                    attrname = self._ROLE_TO_ATTR[c.role]
+                attrname = role_to_attr.get(c.role)
+                if attrname is not None:
                     setattr(self, attrname, c)
                     comps_with_role.append(c)
-                except KeyError:
-                    pass
 
                 # (also) add it to the detectors lists
                 if c.role.startswith("ccd"):
@@ -376,6 +383,10 @@ class MainGUIData(object):
         # MicroscopyGUIData would be better in theory, but is less convenient
         # do directly access additional GUI information.
         self.tab = model.VAEnumerated(None, choices={None: ""})
+        # Reverse index name -> tab for getTabByName, rebuilt whenever the
+        # choices dict is replaced (cf _set_choices, which always copies)
+        self._tab_by_name = None
+        self._tab_by_name_src = None
 
     def stopMotion(self):
         """
@@ -384,21 +395,20 @@ class MainGUIData(object):
         if self.microscope is None:
             return
 
-        ts = []
-        for c in self.microscope.children.value:
-            # Actuators have an .axes roattribute
-            if not isinstance(c.axes, collections.Mapping):
-                continue
-            # Run each of them in a separate thread, to ensure we stop all ASAP
-            t = threading.Thread(target=self._stopActuator, name=c.name, args=(c,))
-            t.start()
-            ts.append(t)
+        # Actuators have an .axes roattribute
+        acts = [c for c in self.microscope.children.value
+                if isinstance(c.axes, collections.abc.Mapping)]
+        if not acts:
+            logging.info("Stopped motion on every axes")
+            return
 
-        # Wait for all the threads to be finished
-        for t in ts:
-            t.join(5)
-            if t.isAlive():
-                logging.warning("Actuator %s still not done stopping after 5s", t.name)
+        # Run each stop in a separate thread, to ensure we stop all ASAP
+        executor = futures.ThreadPoolExecutor(max_workers=len(acts))
+        fs = {executor.submit(self._stopActuator, c): c for c in acts}
+        done, not_done = futures.wait(fs, timeout=5)
+        for f in not_done:
+            logging.warning("Actuator %s still not done stopping after 5s", fs[f].name)
+        executor.shutdown(wait=False)  # don't wait for the laggards
         logging.info("Stopped motion on every axes")
 
     def _stopActuator(self, actuator):
@@ -419,12 +429,16 @@ class MainGUIData(object):
         raise:
             LookupError: if no tab exists with such a name
         """
-        for t, n in self.tab.choices.items():
-            if n == name:
-                return t
-        else:
+        choices = self.tab.choices
+        if self._tab_by_name is None or self._tab_by_name_src is not choices:
+            self._tab_by_name = {n: t for t, n in choices.items()}
+            self._tab_by_name_src = choices
+
+        try:
+            return self._tab_by_name[name]
+        except KeyError:
             raise LookupError("Failed to find tab %s among %d defined tabs" %
-                              (name, len(self.tab.choices)))
+                              (name, len(choices)))
 
 
 class MicroscopyGUIData(with_metaclass(ABCMeta, object)):
@@ -514,8 +528,7 @@ class MicroscopyGUIData(with_metaclass(ABCMeta, object)):
         # See class docstring for more info.
         self.focussedView = VigilantAttribute(None)
 
-        layouts = {VIEW_LAYOUT_ONE, VIEW_LAYOUT_22, VIEW_LAYOUT_FULLSCREEN}
-        self.viewLayout = model.IntEnumerated(VIEW_LAYOUT_22, choices=layouts)
+        self.viewLayout = model.IntEnumerated(VIEW_LAYOUT_22, choices=VIEW_LAYOUTS)
 
         # The subset of views taken from `views` that *can* actually displayed,
         # but they might be hidden as well.
@@ -565,16 +578,14 @@ class LiveViewGUIData(MicroscopyGUIData):
 
         # Represent the global state of the microscopes. Mostly indicating
         # whether optical/sem streams are active.
-        hw_states = {STATE_OFF, STATE_ON, STATE_DISABLED}
-
         if main.ccd or main.photo_ds:
-            self.opticalState = model.IntEnumerated(STATE_OFF, choices=hw_states)
+            self.opticalState = model.IntEnumerated(STATE_OFF, choices=HW_STATES)
             if main.laser_mirror:
                 # For storing shared settings to all confocal streams
                 self.confocal_set_stream = None
 
         if main.ebeam:
-            self.emState = model.IntEnumerated(STATE_OFF, choices=hw_states)
+            self.emState = model.IntEnumerated(STATE_OFF, choices=HW_STATES)
 
         # history list of visited stage positions, ordered with latest visited
         # as last entry.
@@ -769,23 +780,27 @@ class ActuatorGUIData(MicroscopyGUIData):
         # role/axis ("mirror/x") -> (actuator ("mirror"), stepsize ("mirror_r"))
         self._axis_to_act_ss = {}
 
-        # remove the ones that don't have an actuator
+        # skip the ones that don't have an actuator
+        axes_set = set()  # (str, str): actuator name, axis name
         for ss, (v, r, an, axn) in ss_def.items():
-            if getattr(main, an) is not None:
-                self.stepsizes[ss] = FloatContinuous(v, r)
+            act = getattr(main, an)
+            if act is None:
+                continue
+            self.stepsizes[ss] = FloatContinuous(v, r)
 
-                all_axn = set(getattr(main, an).axes.keys())
-                if axn is None: # take all of them
-                    axn = all_axn
-                else: # take only the one listed
-                    axn &= all_axn
+            all_axn = set(act.axes.keys())
+            if axn is None: # take all of them
+                axn = all_axn
+            else: # take only the one listed
+                axn &= all_axn
 
-                for a in axn:
-                    self._axis_to_act_ss[(an, a)] = (an, ss)
-                    logging.debug("Add axis %s/%s to stepsize %s", an, a, ss)
+            for a in axn:
+                self._axis_to_act_ss[(an, a)] = (an, ss)
+                axes_set.add((an, a))
+                logging.debug("Add axis %s/%s to stepsize %s", an, a, ss)
 
         # set of (str, str): actuator name, axis name
-        self.axes = frozenset(self._axis_to_act_ss.keys())
+        self.axes = frozenset(axes_set)
 
     def step(self, actuator, axis, factor, sync=False):
         """
@@ -984,6 +999,9 @@ class FileInfo(object):
     inside a file. It's mostly aimed at containing information, and its
     attributes should be considered readonly after initialisation.
     """
+    # One instance exists per file shown in the GUI, so avoid paying for a
+    # per-instance __dict__
+    __slots__ = ("file_name", "file_obj", "metadata")
 
     def __init__(self, a_file=None, metadata=None):
         """
@@ -1014,10 +1032,14 @@ class FileInfo(object):
         if model.MD_ACQ_DATE not in self.metadata and self.file_name:
             # try to auto fill acquisition time (seconds from epoch)
             try:
-                acq_date = os.stat(self.file_name).st_ctime
+                if self.file_obj is not None:
+                    # The file is already open => no need to resolve the path again
+                    acq_date = os.fstat(self.file_obj.fileno()).st_ctime
+                else:
+                    acq_date = os.stat(self.file_name).st_ctime
                 self.metadata[model.MD_ACQ_DATE] = acq_date
-            except OSError:
-                # can't open the file => just cannot guess the time
+            except (OSError, AttributeError, ValueError):
+                # can't open/stat the file => just cannot guess the time
                 pass
 
     @property
@@ -1156,7 +1178,21 @@ class StreamView(View):
         # Only modify with this lock acquired:
         # TODO: Is this the source of the intermittent locking of the GUI when
         # Streams are active? If so, is there another/better way?
-        self._streams_lock = threading.Lock()
+        # Reentrant, so that a callback triggered while holding the lock (eg,
+        # a stream subscriber calling back into the view) cannot self-deadlock.
+        self._streams_lock = threading.RLock()
+        # Shadow index of the (unwrapped) streams present in the tree, kept in
+        # sync with it under _streams_lock, for O(1) membership tests.
+        self._stream_set = set()
+        # Snapshots of the flattened tree (with and without the projection
+        # wrappers), refreshed under the lock after every mutation. Readers
+        # just pick up the (atomically swapped) references, so the render path
+        # never re-walks the tree nor waits on a stream addition/removal.
+        self._projections_snapshot = ()
+        self._flat_streams = ()
+        # Debouncing of the lastUpdate notifications (cf _scheduleUpdate())
+        self._update_lock = threading.Lock()
+        self._update_timer = None
 
         # TODO: list of annotations to display
         self.show_crosshair = model.BooleanVA(True)
@@ -1367,13 +1403,14 @@ class StreamView(View):
         # distance (because on the overview cam a move can be much bigger than
         # on a SEM image at high mag).
 
-        # Check it makes sense (=> not too big)
-        distance = math.hypot(*shift)
-        if distance > MAX_SAFE_MOVE_DISTANCE:
+        # Check it makes sense (=> not too big). Compare the squared distances,
+        # so the common path doesn't need any sqrt.
+        dist2 = shift[0] * shift[0] + shift[1] * shift[1]
+        if dist2 > MAX_SAFE_MOVE_DISTANCE ** 2:
             logging.error("Cancelling request to move by %f m (because > %f m)",
-                          distance, MAX_SAFE_MOVE_DISTANCE)
+                          math.sqrt(dist2), MAX_SAFE_MOVE_DISTANCE)
             return
-        elif distance < 0.1e-9:
+        elif dist2 < (0.1e-9) ** 2:
             logging.debug("skipping move request of almost 0")
             return
 
@@ -1444,6 +1481,18 @@ class StreamView(View):
         if ex:
             logging.warning("Stage move failed: %s", ex)
 
+    def _refreshSnapshots(self):
+        """
+        Rebuild the lock-free snapshots of the stream tree.
+        Must be called with _streams_lock held, after every tree mutation.
+        """
+        projs = tuple(self.stream_tree.getProjections())
+        self._projections_snapshot = projs
+        # projs contains either Streams or DataProjections, so also keep a
+        # version converted back to only streams.
+        self._flat_streams = tuple(s.stream if isinstance(s, DataProjection) else s
+                                   for s in projs)
+
     def getStreams(self):
         """
         :return: [Stream] list of streams that are displayed in the view
@@ -1451,10 +1500,7 @@ class StreamView(View):
         Do not modify directly, use addStream(), and removeStream().
         Note: use .stream_tree for getting the raw StreamTree (with the DataProjection)
         """
-        ss = self.stream_tree.getProjections()
-        # ss is a list of either Streams or DataProjections, so need to convert
-        # back to only streams.
-        return [s.stream if isinstance(s, DataProjection) else s for s in ss]
+        return list(self._flat_streams)
 
     def getProjections(self):
         """
@@ -1463,8 +1509,7 @@ class StreamView(View):
         Do not modify directly, use addStream(), and removeStream().
         Note: use .stream_tree for getting the raw StreamTree (with the DataProjection)
         """
-        ss = self.stream_tree.getProjections()
-        return ss
+        return list(self._projections_snapshot)
 
     def addStream(self, stream):
         """
@@ -1473,8 +1518,9 @@ class StreamView(View):
         stream (acq.stream.Stream): stream to add
         If the stream is already present, nothing happens
         """
-        # check if the stream is already present
-        if stream in self.stream_tree:
+        # check if the stream is already present (via the shadow set, which
+        # avoids flattening the whole tree)
+        if stream in self._stream_set:
             logging.warning("Aborting the addition of a duplicate stream")
             return
 
@@ -1492,14 +1538,18 @@ class StreamView(View):
         # operation possible
         with self._streams_lock:
             self.stream_tree.add_stream(stream)
+            self._stream_set.add(stream.stream if isinstance(stream, DataProjection) else stream)
+            self._refreshSnapshots()
 
             # subscribe to the stream's image
-            if hasattr(stream, "image"):
-                stream.image.subscribe(self._onNewImage)
+            img = getattr(stream, "image", None)
+            if img is not None:
+                img.subscribe(self._onNewImage)
 
                 # if the stream already has an image, update now
-                if stream.image.value is not None:
-                    self._onNewImage(stream.image.value)
+                im_val = img.value
+                if im_val is not None:
+                    self._onNewImage(im_val)
             else:
                 logging.debug("No image found for stream %s", type(stream))
 
@@ -1513,7 +1563,11 @@ class StreamView(View):
         stream (Stream): stream to remove
         If the stream is not present, nothing happens
         """
+        # O(1) early-out, without taking the lock
+        if stream not in self._stream_set:
+            return
 
+        removed = False
         with self._streams_lock:
             for node in self.stream_tree.getProjections():
                 ostream = node.stream if isinstance(node, DataProjection) else node
@@ -1527,16 +1581,42 @@ class StreamView(View):
                     # remove stream from the StreamTree()
                     # TODO: handle more complex trees
                     self.stream_tree.remove_stream(node)
-                    # let everyone know that the view has changed
-                    self.lastUpdate.value = time.time()
+                    self._stream_set.discard(ostream)
+                    self._refreshSnapshots()
+                    removed = True
                     break
 
+        if removed:
+            # let everyone know that the view has changed. Done outside of the
+            # lock, as the subscribers can take a while, and could even try to
+            # access the view streams.
+            self._scheduleUpdate()
+
+    def _scheduleUpdate(self):
+        """
+        Notify (via lastUpdate) that the view has changed, with debouncing:
+        requests arriving within a short window (eg, several streams receiving
+        an image of the same frame) are coalesced into a single notification,
+        as each one causes every subscriber to re-render the whole view.
+        """
+        with self._update_lock:
+            if self._update_timer is not None:
+                return  # a notification is already on its way
+            self._update_timer = threading.Timer(0.01, self._fireUpdate)
+            self._update_timer.daemon = True
+            self._update_timer.start()
+
+    def _fireUpdate(self):
+        with self._update_lock:
+            self._update_timer = None
+        self.lastUpdate.value = time.time()
+
     def _onNewImage(self, im):
         """
         Called when one stream has im (DataArray)
         """
         # just let everyone know that the composited image has changed
-        self.lastUpdate.value = time.time()
+        self._scheduleUpdate()
 
     def _onMergeRatio(self, ratio):
         """
@@ -1549,7 +1629,7 @@ class StreamView(View):
             self.stream_tree.kwargs["merge"] = ratio
 
         # just let everyone that the composited image has changed
-        self.lastUpdate.value = time.time()
+        self._scheduleUpdate()
 
     def is_compatible(self, stream_cls):
         """ Check if the given stream class is compatible with this view.
@@ -22,6 +22,7 @@ from __future__ import division
 from past.builtins import basestring, long
 
 import collections
+import collections.abc
 import cv2
 import json
 import logging
@@ -207,6 +208,17 @@ def boolify(s):
     raise ValueError('Not a boolean value: %s' % s)
 
 
+# Exact-type converters for the common scalar cases, to avoid going through the
+# whole isinstance() chain of reproduce_typed_value() on every (recursive) call.
+# Subclasses (eg, numpy scalars) still fall back to the isinstance() checks.
+_scalar_converters = {
+    bool: boolify,
+    int: int,
+    float: float,
+    str: lambda s: s,
+}
+
+
 def reproduce_typed_value(typed_value, str_val):
     """ Convert a string to the type of the given typed value
 
@@ -222,6 +234,9 @@ def reproduce_typed_value(typed_value, str_val):
         TypeError: if type of real value is not supported
 
     """
+    converter = _scalar_converters.get(type(typed_value))
+    if converter is not None:
+        return converter(str_val)
 
     if isinstance(typed_value, bool):
         return boolify(str_val)
@@ -253,7 +268,7 @@ def reproduce_typed_value(typed_value, str_val):
             dict_val[key] = value
 
         return dict_val
-    elif isinstance(typed_value, collections.Iterable):
+    elif isinstance(typed_value, collections.abc.Iterable):
         if typed_value:
             typed_val_elm = typed_value[0]
         else:
@@ -289,7 +304,7 @@ def ensure_tuple(v):
       otherwise it will be returned as is
     return (tuple or object): same a v, but a tuple if v was iterable
     """
-    if isinstance(v, collections.Iterable) and not isinstance(v, basestring):
+    if isinstance(v, collections.abc.Iterable) and not isinstance(v, basestring):
         # convert to a tuple, with each object contained also converted
         return tuple(ensure_tuple(i) for i in v)
     else:
@@ -23,6 +23,7 @@ from __future__ import division
 
 from Pyro4.errors import CommunicationError
 import collections
+import functools
 import logging
 import math
 from odemis import model
@@ -32,9 +33,13 @@ import sys
 import threading
 
 
+@functools.lru_cache(maxsize=64)
 def getSerialDriver(name):
     """
     return (string): the name of the serial driver used for the given port
+    Note: the result is cached per port, as the driver doesn't change during
+    the lifetime of a device. Call getSerialDriver.cache_clear() after a
+    device hot-plug if a fresh lookup is needed.
     """
     # In linux, can be found as link of /sys/class/tty/tty*/device/driver
     if sys.platform.startswith('linux'):
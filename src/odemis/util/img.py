@@ -24,6 +24,8 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+import collections
+import hashlib
 import logging
 import math
 import numpy
@@ -42,54 +44,15 @@ except ImportError:
     logging.warn("Failed to load optimised functions, slow version will be used.")
     img_fast = None
 
-# This is a weave-based optimised version (but weave requires g++ installed)
-#def DataArray2RGB_fast(data, irange, tint=(255, 255, 255)):
-#    """
-#    Do not call directly, use DataArray2RGB.
-#    Fast version of DataArray2RGB, which is based on C code
-#    """
-#    # we use weave to do the assignment in C code
-#    # this only gets compiled on the first call
-#    import scipy.weave as weave
-#    # ensure it's a basic ndarray, otherwise it confuses weave
-#    data = data.view(numpy.ndarray)
-#    w, h = data.shape
-#    ret = numpy.empty((w, h, 3), dtype=numpy.uint8)
-#    assert irange[0] < irange[1]
-#    irange = numpy.array(irange, dtype=data.dtype) # ensure it's the same type
-#    tintr = numpy.array([t / 255 for t in tint], dtype=numpy.float)
-#
-#    # TODO: special code when tint == white (should be 2x faster)
-#    code = """
-#    int impos=0;
-#    int retpos=0;
-#    float b = 255. / float(irange[1] - irange[0]);
-#    float d;
-#    for(int j=0; j<Ndata[1]; j++)
-#    {
-#        for (int i=0; i<Ndata[0]; i++)
-#        {
-#            // clip
-#            if (data[impos] <= irange[0]) {
-#                d = 0;
-#            } else if (data[impos] >= irange[1]) {
-#                d = 255;
-#            } else {
-#                d = float(data[impos] - irange[0]) * b;
-#            }
-#            // Note: can go x2 faster if tintr is skipped
-#            ret[retpos++] = d * tintr[0];
-#            ret[retpos++] = d * tintr[1];
-#            ret[retpos++] = d * tintr[2];
-#            impos++;
-#        }
-#    }
-#    """
-#    weave.inline(code, ["data", "ret", "irange", "tintr"])
-#    return ret
-
-
-def findOptimalRange(hist, edges, outliers=0):
+# Cache of the last computed ranges, keyed on a hash of the histogram content
+# (cf findOptimalRange). Hashing is much cheaper than the cumsum+searchsorted,
+# and the GUI tends to query the same histogram many times in a row while the
+# user adjusts the outliers or the image doesn't change.
+_optimal_range_cache = collections.OrderedDict()
+_OPTIMAL_RANGE_CACHE_SIZE = 16
+
+
+def findOptimalRange(hist, edges, outliers=0, cum_hist=None):
     """
     Find the intensity range fitting best an image based on the histogram.
     hist (ndarray 1D of 0<=int): histogram
@@ -97,8 +60,32 @@ def findOptimalRange(hist, edges, outliers=0):
       bin of the histogram. To get an index, use edges = (0, len(hist)).
     outliers (0<float<0.5): ratio of outliers to discard (on both side). 0
       discards no value, 0.5 discards every value (and so returns the median).
+    cum_hist (None or ndarray 1D of 0<=int): hist.cumsum(), if the caller
+      already has it (eg, because it queries the same histogram with several
+      outlier ratios). It will not be modified. If None, it's computed.
     return (tuple of 2 values): the range (min and max values)
     """
+    key = (hashlib.blake2b(hist.tobytes(), digest_size=8).digest(),
+           tuple(edges), outliers)
+    try:
+        rng = _optimal_range_cache[key]
+        _optimal_range_cache.move_to_end(key)
+        return rng
+    except KeyError:
+        pass
+
+    rng = _findOptimalRange(hist, edges, outliers, cum_hist)
+
+    _optimal_range_cache[key] = rng
+    if len(_optimal_range_cache) > _OPTIMAL_RANGE_CACHE_SIZE:
+        _optimal_range_cache.popitem(last=False)
+    return rng
+
+
+def _findOptimalRange(hist, edges, outliers, cum_hist):
+    """
+    Computation part of findOptimalRange(), without the caching.
+    """
     # If we got an histogram with only one value, don't try too hard.
     if len(hist) < 2:
         return edges
@@ -113,7 +100,8 @@ def findOptimalRange(hist, edges, outliers=0):
             return edges
     else:
         # accumulate each bin into the next bin
-        cum_hist = hist.cumsum()
+        if cum_hist is None:
+            cum_hist = hist.cumsum()
         nval = cum_hist[-1]
 
         # If it's an histogram of an empty array, don't try too hard.
@@ -124,7 +112,7 @@ def findOptimalRange(hist, edges, outliers=0):
         # value just above it, it's a sign that the black is not part of the
         # signal and so is all outliers
         if hist[1] == 0 and cum_hist[0] / nval > 0.01 and cum_hist[0] < nval:
-            cum_hist -= cum_hist[0] # don't count 0's in the outliers
+            cum_hist = cum_hist - cum_hist[0]  # don't count 0's in the outliers
             nval = cum_hist[-1]
 
         # find out how much is the value corresponding to outliers
@@ -133,7 +121,7 @@ def findOptimalRange(hist, edges, outliers=0):
 
         # search for first bin equal or above lowv
         lowi = numpy.searchsorted(cum_hist, lowv, side="right")
-        if hist[lowi] == lowv:
+        if lowi < hist.size and hist[lowi] == lowv:
             # if exactly lowv -> remove this bin too, otherwise include the bin
             lowi += 1
         # same with highv (note: it's always found, so highi is always
@@ -188,30 +176,25 @@ def compactHistogram(hist, length):
     chist = hist.reshape(length, hist.size // length)
     return numpy.sum(chist, 1)
 
-# TODO: compute histogram faster. There are several ways:
-# * x=numpy.bincount(a.flat, minlength=depth) => fast (~0.03s for
-#   a 2048x2048 array) but only works on flat array with uint8 and uint16 and
-#   creates 2**16 bins if uint16 (so need to do a reshape and sum on top of it)
-# * numpy.histogram(a, bins=256, range=(0,depth)) => slow (~0.09s for a
-#   2048x2048 array) but works exactly as needed directly in every case.
-# * see weave? (~ 0.01s for 2048x2048 array of uint16) eg:
-#  timeit.timeit("counts=numpy.zeros((2**16), dtype=numpy.uint32);
-#  weave.inline( code, ['counts', 'idxa'])", "import numpy;from scipy import weave; code=r\"for (int i=0; i<Nidxa[0]; i++) { COUNTS1( IDXA1(i)>>8)++; }\"; idxa=numpy.ones((2048*2048), dtype=numpy.uint16)+15", number=100)
-# * see cython?
-# for comparison, a.min() + a.max() are 0.01s for 2048x2048 array
-
-
-def histogram(data, irange=None):
+# Note: if the histogram computation ever needs to go faster than the
+# bincount/numpy.histogram split below, the next step is a dedicated Cython
+# routine in img_fast (cf util/img_fast.pyx, which already hosts the fast
+# uint16 -> RGB conversion).
+def histogram(data, irange=None, bins=None):
     """
     Compute the histogram of the given image.
     data (numpy.ndarray of numbers): greyscale image
     irange (None or tuple of 2 unsigned int): min/max values to be found
       in the data. None => auto (min, max will be detected from the data)
+    bins (None or 1<=int): maximum number of bins wanted. If provided, and the
+      natural histogram length is a multiple of it, the bins are summed
+      together directly (as in compactHistogram), saving a second pass over
+      the full-length histogram.
     return hist, edges:
      hist (ndarray 1D of 0<=int): number of pixels with the given value
       Note that the length of the returned histogram is not fixed. If irange
       is defined and data is integer, the length is always equal to
-      irange[1] - irange[0] + 1.
+      irange[1] - irange[0] + 1, unless bins is passed and divides it.
      edges (tuple of numbers): lowest and highest bound of the histogram.
        edges[1] is included in the bin. If irange is defined, it's the same
        values.
@@ -222,11 +205,13 @@ def histogram(data, irange=None):
             irange = (idt.min, idt.max)
             if data.itemsize > 2:
                 # range is too big to be used as is => look really at the data
-                irange = (int(data.view(numpy.ndarray).min()),
-                          int(data.view(numpy.ndarray).max()))
+                # cast to ndarray to ensure a scalar (instead of a DataArray)
+                d = data.view(numpy.ndarray)
+                irange = (int(d.min()), int(d.max()))
         else:
             # cast to ndarray to ensure a scalar (instead of a DataArray)
-            irange = (data.view(numpy.ndarray).min(), data.view(numpy.ndarray).max())
+            d = data.view(numpy.ndarray)
+            irange = (d.min(), d.max())
 
     # short-cuts (for the most usual types)
     if data.dtype.kind in "bu" and irange[0] == 0 and data.itemsize <= 2 and len(data) > 0:
@@ -235,16 +220,25 @@ def histogram(data, irange=None):
         # TODO: for 32 or 64 bits with full range, convert to a view looking
         # only at the 2 high bytes.
         length = irange[1] - irange[0] + 1
-        hist = numpy.bincount(data.flat, minlength=length)
+        # bincount needs a contiguous 1D ndarray to run at C speed: DataArray
+        # views/slices would make it fall back to a slow flatiter-based path.
+        arr = numpy.ascontiguousarray(data.view(numpy.ndarray)).ravel()
+        hist = numpy.bincount(arr, minlength=length)
         edges = (0, hist.size - 1)
         if edges[1] > irange[1]:
             logging.warning("Unexpected value %d outside of range %s", edges[1], irange)
+        elif bins is not None and bins < hist.size and hist.size % bins == 0:
+            # Directly accumulate to the requested number of bins, without a
+            # separate compactHistogram() pass
+            hist = hist.reshape(bins, hist.size // bins).sum(1)
     else:
         if data.dtype.kind in "biu":
             length = min(8192, irange[1] - irange[0] + 1)
+            if bins is not None:
+                length = min(length, bins)
         else:
             # For floats, it will automatically find the minimum and maximum
-            length = 256
+            length = bins or 256
         hist, all_edges = numpy.histogram(data, bins=length, range=irange)
         edges = (max(irange[0], all_edges[0]),
                  min(irange[1], all_edges[-1]))
@@ -295,7 +289,43 @@ def isClipping(data, drange=None):
 
 # TODO: try to do cumulative histogram value mapping (=histogram equalization)?
 # => might improve the greys, but might be "too" clever
-def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
+def _DataArray2RGB_lut16(data, irange, tint, writable):
+    """
+    uint16-specific part of DataArray2RGB, which precomputes the value -> uint8
+    mapping as a 65536-entry table (64 KiB, fits in cache) and applies it with
+    a single gather pass per channel, instead of running clip/subtract/multiply
+    over the whole image. Used when img_fast is not available.
+    Same contract as DataArray2RGB, but data must be a 2D uint16 ndarray and
+    irange must already be sanitised (irange[0] < irange[1]).
+    """
+    # Same arithmetic as the generic path: clip, shift, scale, truncate
+    vals = numpy.arange(65536, dtype=numpy.float64)
+    vals.clip(irange[0], irange[1], out=vals)
+    vals -= irange[0]
+    b = 255.99 / (irange[1] - irange[0])
+    lut = (vals * b).astype(numpy.uint8)
+
+    if tint == (255, 255, 255):
+        if not writable:
+            grey = lut.take(data)
+            return numpy.broadcast_to(grey[..., numpy.newaxis], data.shape + (3,))
+        rgb = numpy.empty(data.shape + (3,), dtype=numpy.uint8, order='C')
+        lut.take(data, out=rgb[:, :, 0])
+        rgb[:, :, 1] = rgb[:, :, 0]
+        rgb[:, :, 2] = rgb[:, :, 0]
+    else:
+        # One table per channel, with the tint folded in => no per-pixel multiply
+        rgb = numpy.empty(data.shape + (3,), dtype=numpy.uint8, order='C')
+        for i, t in enumerate(tint):
+            # multiply in float, and only then truncate to uint8, as the
+            # generic per-pixel multiply did
+            lut_c = (lut * (t / 255)).astype(numpy.uint8)
+            lut_c.take(data, out=rgb[:, :, i])
+
+    return rgb
+
+
+def DataArray2RGB(data, irange=None, tint=(255, 255, 255), writable=True):
     """
     :param data: (numpy.ndarray of unsigned int) 2D image greyscale (unsigned
         float might work as well)
@@ -306,6 +336,11 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
         min must be < max, and must be of the same type as data.dtype.
     :param tint: (3-tuple of 0 < int <256) RGB colour of the final image (each
         pixel is multiplied by the value. Default is white.
+    :param writable: (bool) If False, and no tint is requested, the returned
+        array may be a read-only broadcast view where the three channels share
+        the same greyscale buffer, which avoids writing the image three times.
+        Only use it when the caller just reads the result (eg, to copy it into
+        a bitmap).
     :return: (numpy.ndarray of 3*shape of uint8) converted image in RGB with the
         same dimension
     """
@@ -332,6 +367,8 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
         if irange[0] == irange[1]:
             logging.info("Requested RGB conversion with null-range %s", irange)
 
+    rgb = None  # final (H, W, 3) array, possibly allocated early (cf below)
+
     if data.dtype == numpy.uint8 and irange[0] == 0 and irange[1] == 255:
         # short-cut when data is already the same type
         # logging.debug("Applying direct range mapping to RGB")
@@ -351,26 +388,45 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
 
             if img_fast:
                 try:
-                    # only (currently) supports uint16
+                    # only (currently) supports contiguous uint16: copying a
+                    # view is cheaper than falling back to the numpy path
+                    if not data.flags.c_contiguous:
+                        data = numpy.ascontiguousarray(data)
                     return img_fast.DataArray2RGB(data, irange, tint)
                 except ValueError as exp:
                     logging.info("Fast conversion cannot run: %s", exp)
                 except Exception:
                     logging.exception("Failed to use the fast conversion")
 
+            if data.dtype == numpy.uint16:
+                # Mapping is a pure function of the pixel value => use a LUT
+                return _DataArray2RGB_lut16(data, irange, tint, writable)
+
             if irange[0] > idt.min or irange[1] < idt.max:
+                # clip() returns a fresh array, so the shift can be done
+                # in-place, sparing one full-size buffer
                 data = data.clip(*irange)
+                dshift = numpy.subtract(data, irange[0], out=data)
+            else:
+                dshift = data - irange[0]
         else: # floats et al. => always clip
             # Ensure B&W if there is just one value allowed
             if irange[0] >= irange[1]:
                 irange = (irange[0] - 1e-9, irange[0])
             data = data.clip(*irange)
-
-        dshift = data - irange[0]
-        if data.dtype == numpy.uint8:
+            dshift = numpy.subtract(data, irange[0], out=data)
+        if tint == (255, 255, 255) and not writable:
+            # The result will be a broadcast of this buffer (cf below)
+            drescaled = numpy.empty(data.shape, dtype=numpy.uint8)
+        elif tint == (255, 255, 255):
+            # No tint => the RGB channels will all be exact copies of the
+            # rescaled data, so write it directly into the red channel, which
+            # saves a separate buffer and one copy pass.
+            rgb = numpy.empty(data.shape + (3,), dtype=numpy.uint8, order='C')
+            drescaled = rgb[:, :, 0]
+        elif data.dtype == numpy.uint8:
             drescaled = dshift  # re-use memory for the result
         else:
-            # TODO: could directly use one channel of the 'rgb' variable?
             drescaled = numpy.empty(data.shape, dtype=numpy.uint8)
         # Ideally, it would be 255 / (irange[1] - irange[0]) + 0.5, but to avoid
         # the addition, we can just use 255.99, and with the rounding down, it's
@@ -378,13 +434,23 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
         b = 255.99 / (irange[1] - irange[0])
         numpy.multiply(dshift, b, out=drescaled, casting="unsafe")
 
+    if tint == (255, 255, 255) and not writable:
+        # Zero copy: the three channels are strided views of the same
+        # greyscale buffer. The result is read-only (and, for pass-through
+        # uint8 data, may even alias the input array).
+        return numpy.broadcast_to(drescaled[..., numpy.newaxis], data.shape + (3,))
+
     # Now duplicate it 3 times to make it RGB (as a simple approximation of
     # greyscale)
     # dstack doesn't work because it doesn't generate in C order (uses strides)
     # apparently this is as fast (or even a bit better):
 
-    # 0 copy (1 malloc)
-    rgb = numpy.empty(data.shape + (3,), dtype=numpy.uint8, order='C')
+    # 0 copy (1 malloc), unless it was already allocated during the rescaling
+    if rgb is None:
+        rgb = numpy.empty(data.shape + (3,), dtype=numpy.uint8, order='C')
+        first_filled = False
+    else:
+        first_filled = True  # the red channel already holds the rescaled data
 
     # Tint (colouration)
     if tint == (255, 255, 255):
@@ -392,17 +458,20 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
         # Note: it seems numpy.repeat() is 10x slower ?!
         # a = numpy.repeat(drescaled, 3)
         # a.shape = data.shape + (3,)
-        rgb[:, :, 0] = drescaled # 1 copy
+        if not first_filled:
+            rgb[:, :, 0] = drescaled # 1 copy
         rgb[:, :, 1] = drescaled # 1 copy
         rgb[:, :, 2] = drescaled # 1 copy
     else:
-        rtint, gtint, btint = tint
-        # multiply by a float, cast back to type of out, and put into out array
-        # TODO: multiplying by float(x/255) is the same as multiplying by int(x)
-        #       and >> 8
-        numpy.multiply(drescaled, rtint / 255, out=rgb[:, :, 0], casting="unsafe")
-        numpy.multiply(drescaled, gtint / 255, out=rgb[:, :, 1], casting="unsafe")
-        numpy.multiply(drescaled, btint / 255, out=rgb[:, :, 2], casting="unsafe")
+        # drescaled is always uint8 at this point, so fold each tint factor
+        # into a 256-entry table and gather, instead of running a float
+        # multiply + cast pass over the whole image per channel.
+        greys = numpy.arange(256, dtype=numpy.uint8)
+        for i, t in enumerate(tint):
+            # multiply in float, and only then truncate to uint8, as the
+            # original per-pixel multiply did
+            lut = (greys * (t / 255)).astype(numpy.uint8)
+            lut.take(drescaled, out=rgb[:, :, i])
 
     return rgb
 
@@ -542,8 +611,13 @@ def rescale_hq(data, shape):
             interpolation = cv2.INTER_AREA  # Gives best looking when shrinking
         else:
             interpolation = cv2.INTER_LINEAR
+        # OpenCV needs a C-contiguous plain ndarray (DataArray slices might
+        # not be contiguous)
+        d = data.view(numpy.ndarray)
+        if not d.flags.c_contiguous:
+            d = numpy.ascontiguousarray(d)
         # If a 3rd dim, OpenCV will apply the resize on each C independently
-        out = cv2.resize(data, (shape[1], shape[0]), interpolation=interpolation)
+        out = cv2.resize(d, (shape[1], shape[0]), interpolation=interpolation)
     else:
         # Weird number of dimensions => default to the less pretty but more
         # generic scipy version
@@ -637,43 +711,40 @@ def mergeMetadata(current, correction=None):
     if correction is not None:
         current.update(correction)
 
+    # Each correction metadata is popped (which also makes it clear the
+    # correction has been applied), so only one dict lookup is done per key.
     # TODO: rotation and position correction should use addition, not subtraction
-    if model.MD_ROTATION_COR in current:
+    rotation_cor = current.pop(model.MD_ROTATION_COR, None)
+    if rotation_cor is not None:
         # Default rotation is 0 rad if not specified
-        rotation_cor = current[model.MD_ROTATION_COR]
         rotation = current.get(model.MD_ROTATION, 0)
         current[model.MD_ROTATION] = (rotation - rotation_cor) % (math.pi * 2)
 
-    if model.MD_POS_COR in current:
+    position_cor = current.pop(model.MD_POS_COR, None)
+    if position_cor is not None:
         # Default position is (0, 0) if not specified
-        position_cor = current[model.MD_POS_COR]
         position = current.get(model.MD_POS, (0, 0))
 
         current[model.MD_POS] = (position[0] - position_cor[0],
                                  position[1] - position_cor[1])
 
-    if model.MD_SHEAR_COR in current:
+    shear_cor = current.pop(model.MD_SHEAR_COR, None)
+    if shear_cor is not None:
         # Default shear is 0 if not specified
-        shear_cor = current[model.MD_SHEAR_COR]
         shear = current.get(model.MD_SHEAR, 0)
 
         current[model.MD_SHEAR] = shear - shear_cor
 
     # There is no default pixel size (though in some case sensor pixel size can
     # be used as a fallback)
-    if model.MD_PIXEL_SIZE in current:
-        pxs = current[model.MD_PIXEL_SIZE]
-        # Do the correction for 2D and 3D
-        pxs_cor = current.get(model.MD_PIXEL_SIZE_COR, (1,) * len(pxs))
-        current[model.MD_PIXEL_SIZE] = tuple(p * pc for p, pc in zip(pxs, pxs_cor))
-
-    elif model.MD_PIXEL_SIZE_COR in current:
-        logging.info("Cannot correct pixel size of data with unknown pixel size")
-
-    # remove correction metadata (to make it clear the correction has been applied)
-    for k in (model.MD_ROTATION_COR, model.MD_PIXEL_SIZE_COR, model.MD_POS_COR, model.MD_SHEAR_COR):
-        if k in current:
-            del current[k]
+    pxs_cor = current.pop(model.MD_PIXEL_SIZE_COR, None)
+    if pxs_cor is not None:
+        if model.MD_PIXEL_SIZE in current:
+            pxs = current[model.MD_PIXEL_SIZE]
+            # Do the correction for 2D and 3D
+            current[model.MD_PIXEL_SIZE] = tuple(p * pc for p, pc in zip(pxs, pxs_cor))
+        else:
+            logging.info("Cannot correct pixel size of data with unknown pixel size")
 
 
 def getTilesSize(tiles):
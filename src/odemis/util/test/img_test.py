@@ -105,8 +105,12 @@ class TestFindOptimalRange(unittest.TestCase):
             hist[p1] = 99
             hist[p2] = 99
 
+            # Note: the cache is dropped before every call, otherwise all but
+            # the first iteration would be cache hits, and only the hashing
+            # would be timed
             tstart = time.time()
             for i in range(10000):
+                img._optimal_range_cache.clear()
                 irange = img.findOptimalRange(hist, (0, depth - 1))
             dur_sc = time.time() - tstart
             self.assertEqual(irange, (p1, p2))
@@ -114,6 +118,7 @@ class TestFindOptimalRange(unittest.TestCase):
             # outliers is some small, it's same behaviour as with 0
             tstart = time.time()
             for i in range(10000):
+                img._optimal_range_cache.clear()
                 irange = img.findOptimalRange(hist, (0, depth - 1), 1e-6)
             dur_full = time.time() - tstart
             self.assertEqual(irange, (p1, p2))
@@ -527,6 +532,51 @@ class TestDataArray2RGB(unittest.TestCase):
         self.assertTrue(numpy.all(pixel0 <= pixelg))
         self.assertTrue(numpy.all(pixelg <= pixel1))
 
+    def test_tint_lut16(self):
+        """test that the uint16 LUT path gives the same result as the generic path"""
+        size = (1024, 1024)
+        depth = 4096
+        grey_img = numpy.zeros(size, dtype="uint16") + depth // 2
+        grey_img[0, 0] = 0
+        grey_img[0, 1] = depth - 1
+
+        tint = (0, 73, 255)
+        # force the pure-numpy paths, even if the optimised module is compiled
+        img_fast = img.img_fast
+        img.img_fast = None
+        try:
+            out = img.DataArray2RGB(grey_img, irange=(0, depth - 1), tint=tint)
+            # int16 data takes the generic (non-LUT) path => must be identical
+            ref = img.DataArray2RGB(grey_img.astype(numpy.int16),
+                                    irange=(0, depth - 1), tint=tint)
+        finally:
+            img.img_fast = img_fast
+
+        self.assertEqual(out.shape, size + (3,))
+        numpy.testing.assert_array_equal(out[0, 1], list(tint))
+        numpy.testing.assert_array_equal(out, ref)
+
+    def test_read_only(self):
+        """test that writable=False returns the same values, as a read-only array"""
+        depth = 4096
+        grey_img = numpy.zeros((512, 256), dtype="uint16") + depth // 2
+        grey_img[0, 0] = 0
+        grey_img[0, 1] = depth - 1
+
+        # force the pure-numpy paths, even if the optimised module is compiled
+        img_fast = img.img_fast
+        img.img_fast = None
+        try:
+            # uint16 uses the LUT path, int16 the generic path
+            for data in (grey_img, grey_img.astype(numpy.int16)):
+                out = img.DataArray2RGB(data, irange=(0, depth - 1), writable=False)
+                self.assertFalse(out.flags.writeable)
+                ref = img.DataArray2RGB(data, irange=(0, depth - 1))
+                self.assertTrue(ref.flags.writeable)
+                numpy.testing.assert_array_equal(out, ref)
+        finally:
+            img.img_fast = img_fast
+
     def test_uint8(self):
         # uint8 is special because it's so close from the output that bytescale
         # normally does nothing